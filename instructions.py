@@ -9,18 +9,48 @@ for readability, as such the output code is rather ugly/contains strange
 seemingly pointless intermediary states etc.
 """
 
+import re
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 from dataclasses import dataclass
-from math import ceil
+from functools import lru_cache, wraps
 from os import path
 from sys import stderr
-from typing import List, Optional, Tuple, Union
+from types import MappingProxyType
+from typing import Iterator, Optional, Sequence, Tuple, Union
 
 try:
     from typing import Literal  # type: ignore
 except ImportError:
     from typing_extensions import Literal  # type: ignore
 
+try:
+    from functools import cached_property  # type: ignore
+except ImportError:
+
+    class cached_property:  # type: ignore
+        """Minimal stand in for functools.cached_property before Python 3.8."""
+
+        def __init__(self, func):
+            self.func = func
+            self.__doc__ = func.__doc__
+
+        def __get__(self, instance, owner=None):
+            if instance is None:
+                return self
+            value = instance.__dict__[self.func.__name__] = self.func(instance)
+            return value
+
+
+def cached_lines(func):
+    """Cache the lines yielded by a generator property as a tuple."""
+
+    @wraps(func)
+    def lines(self):
+        return tuple(func(self))
+
+    return cached_property(lines)
+
+
 DEFAULT_OUT_PATH = path.join(path.dirname(__file__), "src", "instructions.c")
 DEFAULT_LINE_TERMINATOR = "\r\n"
 LINE_TERMINATORS = {
@@ -33,65 +63,182 @@ LINE_TERMINATORS = {
 
 def indented(to_indent: str, indent_depth: int = 1, indent_chars: str = "    ") -> str:
     """Indent the input string."""
-    return "{}{}".format(indent_chars * indent_depth, to_indent)
+    return f"{indent_chars * indent_depth}{to_indent}"
+
+
+def carry_form_pattern(form: str) -> re.Pattern:
+    """Compile a carry form into a pattern matching any operand names and bit."""
+    pattern = re.escape(form)
+    for name, group in (("a", "[A-Za-z]+"), ("b", "[A-Za-z]+"), ("n", "[0-9]+")):
+        placeholder = re.escape("{" + name + "}")
+        pattern = pattern.replace(placeholder, f"(?P<{name}>{group})", 1)
+        pattern = pattern.replace(placeholder, f"(?P={name})")
+    return re.compile(pattern)
+
+
+# Datasheet carry and overflow expressions, and the macros which compute them
+# for every bit of the operands at once
+CARRY_FORMS = tuple((macro, carry_form_pattern(form)) for macro, form in (
+    ("AddCarries", "{a}{n} & {b}{n} | {b}{n} & !R{n} | !R{n} & {a}{n}"),
+    ("SubCarries", "!{a}{n} & {b}{n} | {b}{n} & R{n} | R{n} & !{a}{n}"),
+    ("AddOverflows", "{a}{n} & {b}{n} & !R{n} | !{a}{n} & !{b}{n} & R{n}"),
+    ("SubOverflows", "{a}{n} & !{b}{n} & !R{n} | !{a}{n} & {b}{n} & R{n}"),
+))
+
+
+# Datasheet zero flag expressions which keep Z set only if it was already set,
+# as used by the carry propagating compare and subtract instructions
+PRESERVE_ZERO_FORMS = (
+    "!R7 & !R6 & !R5 & !R4 & !R3 & !R2 & !R1 & !R0 & Z",
+    "(R == 0) && (Z ^ 0)",
+)
+
+
+def carry_form(logic_string: str) -> Optional[Tuple[str, str, str, str]]:
+    """Get the macro, operands and bit of flag logic which is a known carry form, else None."""
+    for macro, pattern in CARRY_FORMS:
+        match = pattern.fullmatch(logic_string)
+        if match:
+            return (macro, *match.group("a", "b", "n"))
+    return None
+
 
+def carry_logic(logic_string: str) -> Optional[str]:
+    """Get closed form C for flag logic which is a known carry form, else None."""
+    form = carry_form(logic_string)
+    if form:
+        macro, a, b, n = form
+        return f"TestBit({macro}({a}, {b}, R), {n})"
+    return None
 
-def flag_logic(logic_string, result_var, machine="m"):
+
+# A term of flag logic, an optionally inverted name and optional bit number
+FLAG_TERM = re.compile(r"(!?)([^0-9]*)(.*)")
+
+
+def equality_logic(logic_string: str) -> Optional[str]:
+    """Get closed form C for flag logic which tests every bit of a byte, else None."""
+    if "|" in logic_string:
+        return None
+    terms = [FLAG_TERM.fullmatch(term.strip()).groups() for term in logic_string.split("&")]
+    names = {var for _, var, _ in terms}
+    if len(names) != 1 or not all(bit.isdigit() for _, _, bit in terms):
+        return None
+    if sorted(int(bit) for _, _, bit in terms) != list(range(8)):
+        return None
+    value = sum(1 << int(bit) for invert, _, bit in terms if not invert)
+    return f"{names.pop()} == 0x{value:02x}"
+
+
+def expand_flag_logic(logic_string: str, result_var: str, machine: str = "m") -> Iterator[str]:
     """Expand simplistic flag logic.
 
     TODO: improve parsing so it's not so ugly.
     """
-    if not set(logic_string).difference(set("0123456789")):
-        yield "{} = {};".format(result_var, logic_string)
+    closed_form = carry_logic(logic_string) or equality_logic(logic_string)
+    if closed_form:
+        yield f"{result_var} = {closed_form};"
+        return
+
+    if logic_string.isdigit():
+        yield f"{result_var} = {logic_string};"
         return
 
     if "^" in logic_string:
         left, right, *_ = logic_string.split("^")
-        yield "{} = {} != {};".format(result_var, left.strip(), right.strip())
+        yield f"{result_var} = {left.strip()} != {right.strip()};"
         return
 
-    or_groups = set()
+    # Terms are kept in the order they are written, dropping any repeats
+    or_groups = dict()
     for or_group in logic_string.split("|"):
-        and_items = set()
+        and_items = dict()
         for and_item in or_group.split("&"):
-            item_result = "{}"
-            and_item = and_item.strip()
-            invert = False
-            if and_item[0] == "!":
-                invert = True
-                and_item = and_item[1:]
-            var = ""
-            while and_item and and_item[0] not in set("0123456789"):
-                var += and_item[0]
-                and_item = and_item[1:]
-            if and_item and not set(and_item).difference(set("0123456789")):
-                item_result = "TestBit({}, {})".format(var, and_item)
-            else:
-                item_result = var
-            if invert:
-                item_result = "!{}".format(item_result)
-            and_items.add(item_result)
-        or_groups.add("{}".format(" && ".join(sorted(and_items))))
+            invert, var, bit = FLAG_TERM.fullmatch(and_item.strip()).groups()
+            item_result = f"TestBit({var}, {bit})" if bit.isdigit() else var
+            and_items[f"{invert}{item_result}"] = None
+        or_groups[" && ".join(and_items)] = None
     if len(or_groups) > 1:
-        for index, or_group in enumerate(sorted(or_groups), 1):
-            yield "const bool {}{} = {};".format(result_var, index, or_group)
-        result = "{}".format(" || ".join(
-            ["{}{}".format(result_var, x) for x in range(1, 1 + len(or_groups))]))
+        for index, or_group in enumerate(or_groups, 1):
+            yield f"const bool {result_var}{index} = {or_group};"
+        result = " || ".join(f"{result_var}{x}" for x in range(1, 1 + len(or_groups)))
     else:
-        result = or_groups.pop()
-    yield "{} = {};".format(result_var, result)
+        result = next(iter(or_groups))
+    yield f"{result_var} = {result};"
+
+
+@lru_cache(maxsize=None)
+def flag_logic(logic_string: str, result_var: str, machine: str = "m") -> Tuple[str, ...]:
+    """Get the expanded flag logic, shared by every instruction with the same logic."""
+    return tuple(expand_flag_logic(logic_string, result_var, machine))
+
+
+# Flags in the order they are read and written back, with the code to do so
+FLAG_READS = {flag: f"bool {flag} = m->SREG[SREG_{flag}];" for flag in "CZNVSH"}
+FLAG_WRITES = {flag: f"m->SREG[SREG_{flag}] = {flag};" for flag in "CZNVSH"}
+
+
+# Size of the smallest data type which can hold a given number of bytes
+DATA_TYPE_SIZES = (8, 8, 16, 32, 32, 64, 64, 64, 64)
+
 
+def hinted_operation(operation: str, hint: str) -> str:
+    """Wrap the condition of an operation which starts with an if in a branch hint."""
+    if not operation.startswith("if("):
+        return operation
+    depth = 0
+    for index, char in enumerate(operation[2:], 2):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                macro = "Likely" if hint == "likely" else "Unlikely"
+                return f"if({macro}({operation[3:index]})){operation[index + 1:]}"
+    return operation
 
-def data_type(bit_width, prefix="uint", postfix="_t"):
+
+@lru_cache(maxsize=None)
+def data_type(bit_width: int, prefix: str = "uint", postfix: str = "_t") -> str:
     """Return a datatype based on a target bit width."""
-    size = 64
-    if bit_width <= 8:
-        size = 8
-    elif bit_width <= 16:
-        size = 16
-    elif bit_width <= 32:
-        size = 32
-    return "{}{}{}".format(prefix, size, postfix)
+    size = DATA_TYPE_SIZES[min((bit_width + 7) // 8, 8)]
+    return f"{prefix}{size}{postfix}"
+
+
+@lru_cache(maxsize=None)
+def var_read(var: str, index: str, size: int) -> str:
+    """Get the code to read a variable of up to 16 bits, shared by every instruction."""
+    reg_type = data_type(size, prefix="Reg", postfix="")
+    if size <= 8:
+        return f"const {reg_type} {var}{index} = m->{var}[{index}];"
+    return f"const {reg_type} {var}{index} = m->{var}[{index}] | (m->{var}[{index} + 1] << 8);"
+
+
+@lru_cache(maxsize=None)
+def decoder_expression(runs: Tuple[Tuple[int, int], ...], pext_mask: int, var: str) -> str:
+    """Generate the C code to decode a variable made of runs of opcode bits.
+
+    Variables split over several runs of bits are wrapped in ExtractBits so
+    they can be gathered with a single PEXT where the target supports it.
+    """
+    group_strings = []
+    end_index = 0
+    for min_index, width in runs:
+        run_mask = (1 << width) - 1
+        if min_index != 0:
+            if end_index == 0:
+                group_strings.append(f"(({var} >> {min_index}) & 0x{run_mask:x})")
+            else:
+                group_strings.append(
+                    f"(({var} >> {min_index - end_index}) & (0x{run_mask:x} << {end_index}))")
+        else:
+            group_strings.append(f"({var} & 0x{run_mask:x})")
+        end_index += width
+
+    if len(group_strings) > 1:
+        return f"ExtractBits({var}, 0x{pext_mask:04x}, ({' | '.join(group_strings)}))"
+
+    return " | ".join(group_strings)
 
 
 @dataclass
@@ -99,51 +246,42 @@ class Variable:
     """Represents a variable in an opcode."""
 
     name: str
-    bits: List[int]
+    bits: Tuple[int, ...]
+
+    def __post_init__(self):
+        """Derive decoding constants once, when the variable is created."""
+        for constant in ("data_type", "pext_mask", "runs"):
+            getattr(self, constant)
 
-    @property
+    @cached_property
     def bit_width(self):
         """Variable bit width."""
-        return ceil(len(self.bits) / 8.0) * 8
+        return (len(self.bits) + 7) & ~7
 
-    @property
+    @cached_property
     def data_type(self):
         """Get data type required to store variable."""
         return data_type(self.bit_width)
 
-    def generate_decoder(self, var="opcode"):
-        """Generate the C code to decode the variable from an opcode."""
-        groups = list()
-        for bit in self.bits:
-            found_group = False
-            for group in groups:
-                if bit + 1 in group or bit - 1 in group:
-                    group.append(bit)
-                    found_group = True
-                    break
-            if not found_group:
-                groups.append([bit])
-
-        group_strings = []
-        end_index = 0
-        for group in reversed(groups):
-            min_index = min(group)
-            if min_index != 0:
-                if end_index == 0:
-                    group_strings.append("(({} >> {}) & 0x{:x})".format(
-                        var, min_index - end_index, 2**len(group) - 1))
-                else:
-                    group_strings.append("(({} >> {}) & (0x{:x} << {}))".format(
-                        var, min_index - end_index, 2**len(group) - 1, end_index))
+    @cached_property
+    def pext_mask(self):
+        """Mask of the opcode bits which make up the variable."""
+        return sum(1 << bit for bit in self.bits)
+
+    @cached_property
+    def runs(self):
+        """Get the (lowest bit, width) of each run of consecutive bits, lowest run first."""
+        runs = list()
+        for bit in sorted(self.bits):
+            if runs and bit == sum(runs[-1]):
+                runs[-1][1] += 1
             else:
-                group_strings.append("({} & 0x{:x})".format(var, 2**len(group) - 1))
-            end_index += len(group)
-
-        bracket_string = "{}"
-        if len(group_strings) > 1:
-            bracket_string = "({})"
+                runs.append([bit, 1])
+        return tuple((start, width) for start, width in runs)
 
-        return bracket_string.format(" | ".join(group_strings))
+    def generate_decoder(self, var: str = "opcode") -> str:
+        """Generate the C code to decode the variable from an opcode."""
+        return decoder_expression(self.runs, self.pext_mask, var)
 
 
 @dataclass
@@ -167,23 +305,30 @@ class Instruction:
     precondition: Optional[str] = None
     pc_post_inc: int = 1
     var_offsets: Optional[Tuple[Union[Tuple[str, int], Tuple[str, int, int]], ...]] = None
+    branch_hint: Optional[Literal["likely", "unlikely"]] = None
+
+    def __post_init__(self):
+        """Derive opcode constants once, when the instruction table is built."""
+        for constant in ("words", "mask", "signature", "variables", "offsets", "arithmetic_flags",
+                         "var_reads", "checks", "check_reads", "check_writes"):
+            getattr(self, constant)
 
-    @property
+    @cached_property
     def is_32bit(self):
         """Return true if this is a double width instruction, false otherwise."""
         return len(self.full_plain_opcode) == 32
 
-    @property
+    @cached_property
     def words(self):
         """Get number of words in this instruction."""
         return 2 if self.is_32bit else 1
 
-    @property
+    @cached_property
     def plain_opcode(self):
         """Get plain 16bit opcode."""
         return self.opcode.replace("_", "")[:16]
 
-    @property
+    @cached_property
     def full_plain_opcode(self):
         """Get plain full opcode.
 
@@ -192,58 +337,93 @@ class Instruction:
         """
         return self.opcode.replace("_", "")[:32]
 
-    @property
+    @cached_property
+    def opcode_values(self):
+        """Get the integer mask and signature of the opcode in a single pass."""
+        mask_value = signature_value = 0
+        for x in self.plain_opcode:
+            mask_value <<= 1
+            signature_value <<= 1
+            if x in ("0", "1"):
+                mask_value |= 1
+                signature_value |= x == "1"
+        return mask_value, signature_value
+
+    @cached_property
     def mask(self):
         """Get bitwise and mask of instruction signature."""
-        bits = "".join("1" if x in ("0", "1") else "0" for x in self.plain_opcode)
-        return "0x{:04x}".format(int(bits, 2))
+        return f"0x{self.opcode_values[0]:04x}"
 
-    @property
+    @cached_property
     def signature(self):
         """Get instruction signature.
 
         This is the value of all bits which are not variable in the opcode.
         """
-        bits = "".join(x if x in ("0", "1") else "0" for x in self.plain_opcode)
-        return "0x{:04x}".format(int(bits, 2))
+        return f"0x{self.opcode_values[1]:04x}"
 
-    @property
+    @cached_property
     def variables(self):
         """Get all variables in this instruction's opcode."""
-        result = dict()
-        unique_chars = set(filter(lambda x: x not in ("0", "1"), self.full_plain_opcode))
-        for c in sorted(unique_chars):
-            bits = list(
-                map(lambda x: len(self.full_plain_opcode) - x[0] - 1,
-                    filter(lambda x: x[1] == c, enumerate(self.full_plain_opcode))))
-            result[c] = Variable(c, bits)
-        return result
-
-    @property
+        bits = dict()
+        top_bit = len(self.full_plain_opcode) - 1
+        for index, c in enumerate(self.full_plain_opcode):
+            if c not in ("0", "1"):
+                bits.setdefault(c, []).append(top_bit - index)
+        return {c: Variable(c, tuple(bits[c])) for c in sorted(bits)}
+
+    @cached_property
+    def offsets(self):
+        """Get the offset and optional multiplier applied to each variable, if any."""
+        return {name: tuple(offset) for name, *offset in self.var_offsets or ()}
+
+    @cached_lines
     def var_reads(self):
         """Get the code to read from registers so on as needed by this instruction."""
         if self.reads:
-            for read in self.reads:
-                var, index, size = read
-                if size <= 8:
-                    yield "const {} {v}{i} = m->{v}[{i}];".format(data_type(size,
-                                                                            prefix="Reg",
-                                                                            postfix=""),
-                                                                  v=var,
-                                                                  i=index)
-                elif size <= 16:
-                    yield "const {} {v}{i} = m->{v}[{i}] | (m->{v}[{i} + 1] << 8);".format(
-                        data_type(size, prefix="Reg", postfix=""), v=var, i=index)
-
-    @property
+            for var, index, size in self.reads:
+                yield var_read(var, index, size)
+
+    @cached_property
+    def arithmetic_flags(self):
+        """Get the kind and operands of an 8 bit add/subtract flag update, else None.
+
+        Instructions which set all of H, S, V, N, Z and C from the result of an
+        add or subtract share a single helper to update them.
+        """
+        if self.flag_n != "R7" or self.flag_s != "N ^ V":
+            return None
+        if self.flag_z != "_" and self.flag_z not in PRESERVE_ZERO_FORMS:
+            return None
+        forms = [carry_form(flag or "") for flag in (self.flag_c, self.flag_h, self.flag_v)]
+        if not all(forms):
+            return None
+        (c_macro, a, b, c_bit), (h_macro, *h_operands, h_bit), (v_macro, *v_operands, v_bit) = forms
+        if (c_bit, h_bit, v_bit) != ("7", "3", "7") or not h_operands == v_operands == [a, b]:
+            return None
+        for kind in ("Add", "Sub"):
+            if (c_macro, h_macro, v_macro) == (kind + "Carries", kind + "Carries",
+                                               kind + "Overflows"):
+                return kind, a, b
+        return None
+
+    @cached_lines
     def checks(self):
         """Get the code to perform all post-operation flag checks."""
+        if self.arithmetic_flags:
+            kind, a, b = self.arithmetic_flags
+            zero = "Z" if self.flag_z in PRESERVE_ZERO_FORMS else "true"
+            yield f"Update{kind}Flags(m, {a}, {b}, R, {zero});"
+            return
+
         if self.flag_n:
             yield from flag_logic(self.flag_n, "N")
 
         if self.flag_z:
             if self.flag_z == "_":
                 yield "Z = R == 0x00;"
+            elif self.flag_z in PRESERVE_ZERO_FORMS:
+                yield "Z = (R == 0x00) & Z;"
             else:
                 yield from flag_logic(self.flag_z, "Z")
 
@@ -259,57 +439,40 @@ class Instruction:
         if self.flag_s:
             yield from flag_logic(self.flag_s, "S")
 
-    @property
+    @cached_lines
     def check_reads(self):
         """Get the code to perform pre-operation flag reads."""
-        if self.flag_c:
-            yield "bool C = m->SREG[SREG_C];"
-
-        if self.flag_z:
-            yield "bool Z = m->SREG[SREG_Z];"
-
-        if self.flag_n:
-            yield "bool N = m->SREG[SREG_N];"
-
-        if self.flag_v:
-            yield "bool V = m->SREG[SREG_V];"
-
-        if self.flag_s:
-            yield "bool S = m->SREG[SREG_S];"
-
-        if self.flag_h:
-            yield "bool H = m->SREG[SREG_H];"
-
-    @property
+        if self.arithmetic_flags:
+            # Only flags the operation itself uses need reading
+            if re.search(r"\bC\b", self.operation):
+                yield FLAG_READS["C"]
+            if self.flag_z in PRESERVE_ZERO_FORMS:
+                yield FLAG_READS["Z"]
+            return
+
+        for flag, flag_read in FLAG_READS.items():
+            if getattr(self, "flag_" + flag.lower()):
+                yield flag_read
+
+    @cached_lines
     def check_writes(self):
         """Get the code to perform post-operation flag writes."""
-        if self.flag_c:
-            yield "m->SREG[SREG_C] = C;"
+        if self.arithmetic_flags:
+            return
 
-        if self.flag_z:
-            yield "m->SREG[SREG_Z] = Z;"
-
-        if self.flag_n:
-            yield "m->SREG[SREG_N] = N;"
+        for flag, flag_write in FLAG_WRITES.items():
+            if getattr(self, "flag_" + flag.lower()):
+                yield flag_write
 
-        if self.flag_v:
-            yield "m->SREG[SREG_V] = V;"
-
-        if self.flag_s:
-            yield "m->SREG[SREG_S] = S;"
-
-        if self.flag_h:
-            yield "m->SREG[SREG_H] = H;"
-
-    @property
+    @cached_lines
     def code(self):
         """Get the function which performs this instruction's operation."""
         # Macro to allow removal of instruction in C code
-        yield "#ifndef INSTRUCTION_{}_MISSING".format(self.mnemonic.upper())
+        yield f"#ifndef INSTRUCTION_{self.mnemonic.upper()}_MISSING"
 
         # Start of implementation
-        yield "static inline void instruction_{}(Machine *m, Mem16 opcode)".format(
-            self.mnemonic.lower())
+        function = f"instruction_{self.mnemonic.lower()}"
+        yield f"static ForceInline void {function}(Machine *m, Mem16 opcode)"
         yield "{"
 
         # Debug macro sections
@@ -317,19 +480,13 @@ class Instruction:
         yield indented('printf("PC(w)=%04x, PC(b)=%04x\\n", GetPC(m), GetPC(m)*2);')
         yield "#endif"
         yield "#ifdef DEBUG_PRINT_MNEMONICS"
-        yield indented('puts("{} {}");'.format(self.mnemonic, self.full_plain_opcode))
+        yield indented(f'puts("{self.mnemonic} {self.full_plain_opcode}");')
         yield "#endif"
 
         # Section heading
-        if any(self.variables):
+        if self.variables:
             yield indented("/* Extract operands from opcode. */")
 
-        # Get offsets if they exist
-        if self.var_offsets:
-            offsets_dict = {k: v for k, *v in self.var_offsets}
-        else:
-            offsets_dict = {}
-
         # If this is a 32 bit instruction we need to perform a second fetch of a word from memory
         if self.is_32bit:
             yield indented(
@@ -338,38 +495,33 @@ class Instruction:
 
         # Code to extract variables from opcodes
         for name, variable in self.variables.items():
-            decoder = "const {} {} = {{}}{}{{}};".format(
-                variable.data_type, name,
-                variable.generate_decoder(var="extended_opcode" if self.is_32bit else "opcode"))
-            if name in offsets_dict:
-                add_val, *mul_val = offsets_dict[name]
+            value = variable.generate_decoder(var="extended_opcode" if self.is_32bit else "opcode")
+            if name in self.offsets:
+                add_val, *mul_val = self.offsets[name]
                 if mul_val:
-                    mul_val = mul_val[0]
-                    yield indented(
-                        decoder.format("({} * ".format(mul_val), ") + {}".format(add_val)))
+                    value = f"({mul_val[0]} * {value}) + {add_val}"
                 else:
-                    yield indented(decoder.format("", " + {}".format(add_val)))
-            else:
-                yield indented(decoder.format("", ""))
+                    value = f"{value} + {add_val}"
+            yield indented(f"const {variable.data_type} {name} = {value};")
             yield "#ifdef DEBUG_PRINT_OPERANDS"
             if name in ("K", ):
-                yield indented('printf("  {n} = 0x%04x\\n", {n});'.format(n=name))
+                yield indented(f'printf("  {name} = 0x%04x\\n", {name});')
             else:
-                yield indented('printf("  {n} = %u\\n", {n});'.format(n=name))
+                yield indented(f'printf("  {name} = %u\\n", {name});')
             yield "#endif"
 
         # Macro to assert precondition if it exists for this instruction
         if self.precondition:
             yield indented("/* Assert preconditions. */")
-            yield indented("PRECONDITION({});".format(self.precondition))
+            yield indented(f"PRECONDITION({self.precondition});")
 
         # Macro to mark any unused variables as "used" to avoid compiler warnings
-        if not any(self.variables):
+        if not self.variables:
             yield indented("/* No operands in opcode so mark as unused. */")
             yield indented("UNUSED(opcode);")
 
         # Section heading
-        if any(self.var_reads):
+        if self.var_reads:
             yield indented("/* Read vars for operation. */")
 
         # Code to read from registers etc. where needed
@@ -377,7 +529,7 @@ class Instruction:
             yield indented(var_read)
 
         # Section heading
-        if any(self.check_reads):
+        if self.check_reads:
             yield indented("/* Read flags for operation. */")
 
         # Read flags before operation
@@ -388,10 +540,13 @@ class Instruction:
         yield indented("/* Perform instruction operation. */")
 
         # Perform operation of instruction
-        yield indented(self.operation)
+        if self.branch_hint:
+            yield indented(hinted_operation(self.operation, self.branch_hint))
+        else:
+            yield indented(self.operation)
 
         # Section heading
-        if any(self.checks):
+        if self.checks:
             yield indented("/* Update flags. */")
 
         # Check for new flag states
@@ -405,7 +560,7 @@ class Instruction:
             yield indented(self.writeback)
 
         # Section heading
-        if any(self.check_writes):
+        if self.check_writes:
             yield indented("/* Writeback flags. */")
 
         # Write flags back
@@ -415,22 +570,20 @@ class Instruction:
         # Perform PC post increment/decrement if applicable
         if self.pc_post_inc != 0:
             yield indented("/* Increment PC. */")
-            yield indented("SetPC(m, GetPC(m) + {});".format(self.pc_post_inc))
+            yield indented(f"SetPC(m, GetPC(m) + {self.pc_post_inc});")
 
         # End of implementation
         yield "}"
 
         # If instruction is "missing" then yield no implementation.
         yield "#else"
-        yield "static inline void instruction_{}(Machine *m, Mem16 opcode)".format(
-            self.mnemonic.lower())
+        yield f"static ForceInline void {function}(Machine *m, Mem16 opcode)"
         yield "{"
         # Produce a warning and perform no actual operation
         # NB: this does not increment PC
         yield indented("UNUSED(opcode);")
         yield indented("UNUSED(m);")
-        yield indented('puts("Warning: Instruction {} not present on MCU");'.format(
-            self.mnemonic.upper()))
+        yield indented(f'puts("Warning: Instruction {self.mnemonic.upper()} not present on MCU");')
         yield "}"
         yield "#endif"
 
@@ -496,7 +649,7 @@ INSTRUCTIONS = (
     Instruction(mnemonic="ASR",
                 opcode="1001_010d_dddd_0101",
                 reads=(("R", "d", 8), ),
-                operation="const Reg8 R = (Rd >> 1) | (Rd & 0x80);",
+                operation="const Reg8 R = (Reg8)((int8_t)Rd >> 1);",
                 writeback="m->R[d] = R;",
                 flag_s="N ^ V",
                 flag_v="N ^ C",
@@ -507,16 +660,16 @@ INSTRUCTIONS = (
     Instruction(mnemonic="BSET", opcode="1001_0100_0sss_1000", operation="SetStatusFlag(m, s);"),
     Instruction(mnemonic="BLD",
                 opcode="1111_100d_dddd_0bbb",
-                operation="m->R[d] = m->SREG[SREG_T] ? SetBit(m->R[d], b) : ClearBit(m->R[d], b);"),
+                operation="m->R[d] = ClearBit(m->R[d], b) | (m->SREG[SREG_T] << b);"),
     Instruction(mnemonic="BST",
                 opcode="1111_101d_dddd_0bbb",
                 operation="m->SREG[SREG_T] = GetBit(m->R[d], b) != 0;"),
     Instruction(mnemonic="BRBC",
                 opcode="1111_01kk_kkkk_ksss",
-                operation="if(!GetStatusFlag(m, s)) SetPC(m, GetPC(m) + ToSigned(k, 7));"),
+                operation="SetPC(m, GetPC(m) + (GetStatusFlag(m, s) ? 0 : ToSigned(k, 7)));"),
     Instruction(mnemonic="BRBS",
                 opcode="1111_00kk_kkkk_ksss",
-                operation="if(GetStatusFlag(m, s)) SetPC(m, GetPC(m) + ToSigned(k, 7));"),
+                operation="SetPC(m, GetPC(m) + (GetStatusFlag(m, s) ? ToSigned(k, 7) : 0));"),
     Instruction(mnemonic="BREAK", opcode="1001_0101_1001_1000", operation="interactive_break(m);"),
     Instruction(mnemonic="CALL",
                 opcode="1001_010k_kkkk_111k_kkkk_kkkk_kkkk_kkkk",
@@ -529,7 +682,7 @@ INSTRUCTIONS = (
     Instruction(mnemonic="COM",
                 opcode="1001_010d_dddd_0000",
                 reads=(("R", "d", 8), ),
-                operation="const Reg8 R = 0xff - Rd;",
+                operation="const Reg8 R = (Reg8)~Rd;",
                 writeback="m->R[d] = R;",
                 flag_s="N ^ V",
                 flag_v="0",
@@ -569,7 +722,8 @@ INSTRUCTIONS = (
                 flag_c="!Rd7 & K7 | K7 & R7 | R7 & !Rd7"),
     Instruction(mnemonic="CPSE",
                 opcode="0001_00rd_dddd_rrrr",
-                operation="if(m->R[d] == m->R[r]) m->SKIP = true;"),
+                operation="if(m->R[d] == m->R[r]) m->SKIP = true;",
+                branch_hint="unlikely"),
     Instruction(mnemonic="DEC",
                 opcode="1001_010d_dddd_1010",
                 reads=(("R", "d", 8), ),
@@ -800,10 +954,12 @@ INSTRUCTIONS = (
                 operation="m->IO[A] = SetBit(m->IO[A], b);"),
     Instruction(mnemonic="SBIC",
                 opcode="1001_1001_AAAA_Abbb",
-                operation="if(!TestBit(m->IO[A], b)) m->SKIP = true;"),
+                operation="if(!TestBit(m->IO[A], b)) m->SKIP = true;",
+                branch_hint="unlikely"),
     Instruction(mnemonic="SBIS",
                 opcode="1001_1011_AAAA_Abbb",
-                operation="if(TestBit(m->IO[A], b)) m->SKIP = true;"),
+                operation="if(TestBit(m->IO[A], b)) m->SKIP = true;",
+                branch_hint="unlikely"),
     Instruction(mnemonic="SBIW",
                 opcode="1001_0111_KKdd_KKKK",
                 var_offsets=(("d", 24, 2), ),
@@ -817,10 +973,12 @@ INSTRUCTIONS = (
                 flag_c="R15 & !Rd15"),
     Instruction(mnemonic="SBRC",
                 opcode="1111_110r_rrrr_0bbb",
-                operation="if(!TestBit(m->R[r], b)) m->SKIP = true;"),
+                operation="if(!TestBit(m->R[r], b)) m->SKIP = true;",
+                branch_hint="unlikely"),
     Instruction(mnemonic="SBRS",
                 opcode="1111_111r_rrrr_0bbb",
-                operation="if(TestBit(m->R[r], b)) m->SKIP = true;"),
+                operation="if(TestBit(m->R[r], b)) m->SKIP = true;",
+                branch_hint="unlikely"),
     Instruction(mnemonic="ST_X_i",
                 opcode="1001_001r_rrrr_1100",
                 operation="SetDataMem(m, Get16(m->X_H, m->X_L), m->R[r]);"),
@@ -893,11 +1051,48 @@ INSTRUCTIONS = (
 )
 
 
-def generate_decode_and_execute():
-    """Generate the instruction decode and execute logic."""
+def generate_decode_body(instructions: Sequence["Instruction"], depth: int = 1) -> Iterator[str]:
+    """Generate the execute logic for decoded instructions sharing a signature and mask."""
+    if len(instructions) == 1:
+        yield indented(f"instruction_{instructions[0].mnemonic.lower()}(m, opcode);",
+                       indent_depth=depth)
+    else:
+        first_instruction = True
+        for name, variable in instructions[0].variables.items():
+            yield indented(f"const {variable.data_type} {name} = {variable.generate_decoder()};",
+                           indent_depth=depth)
+        for instruction in instructions:
+            got_else = False
+            if instruction.precondition:
+                keyword = "if" if first_instruction else "else if"
+                yield indented(f"{keyword} ({instruction.precondition})", indent_depth=depth)
+            else:
+                got_else = True
+                if not first_instruction:
+                    yield indented("else", indent_depth=depth)
+                else:
+                    # If we get here there's at least 2 instruction definitions which conflict
+                    # and don't disambiguate themselves with preconditions.
+                    print("Unwanted Collision: Ambiguous instructions...", file=stderr)
+                    print([instruction.mnemonic for instruction in instructions], file=stderr)
+                    yield indented("#warning Unwanted Collision", indent_depth=depth)
+            yield indented("{", indent_depth=depth)
+            yield indented(f"instruction_{instruction.mnemonic.lower()}(m, opcode);",
+                           indent_depth=depth + 1)
+            yield indented("}", indent_depth=depth)
+            first_instruction = False
+            if got_else:
+                break
+
+
+@lru_cache(maxsize=None)
+def build_instruction_tree():
+    """Group instructions by signature and mask, preconditioned instructions first.
+
+    INSTRUCTIONS never changes, so this is built once and returned read only.
+    """
     # Build a "tree" to find non-unique instructions
     # TODO: Add a second level to group operations that share a mask
-    # TODO: Also clean this whole function up XD
     instruction_tree = {}
     for instruction in INSTRUCTIONS:
         key = (instruction.signature, instruction.mask)
@@ -907,70 +1102,194 @@ def generate_decode_and_execute():
             instruction_tree[key].insert(0, instruction)
         else:
             instruction_tree[key].append(instruction)
+    return MappingProxyType({key: tuple(group) for key, group in instruction_tree.items()})
 
-    yield "void decode_and_execute_instruction(Machine *m, Mem16 opcode) {"
-    yield indented("const bool skip = m->SKIP;")
-    first = True
-    # Generate decode logic
-    for (signature, mask), instructions in instruction_tree.items():
-        yield indented("{}if ((opcode & {m}) == {s})".format("" if first else "else ",
-                                                             m=mask,
-                                                             s=signature))
-        first = False
+
+@lru_cache(maxsize=None)
+def decode_index() -> bytes:
+    """Map every opcode to the position of the first signature and mask which matches it.
+
+    Positions start at 1 so that 0 marks opcodes which cannot be decoded.
+    """
+    index = bytearray(0x10000)
+    # Fill in reverse so where signatures overlap the first one wins
+    for position, instructions in reversed(list(enumerate(build_instruction_tree().values(), 1))):
+        mask, signature = instructions[0].opcode_values
+        free_bits = ~mask & 0xffff
+        # Walk every combination of the variable bits
+        variable_bits = free_bits
+        while True:
+            index[signature | variable_bits] = position
+            if not variable_bits:
+                break
+            variable_bits = (variable_bits - 1) & free_bits
+    return bytes(index)
+
+
+def generate_decode_index() -> Iterator[str]:
+    """Generate the tables mapping every opcode to its position in the decode tree.
+
+    The high byte of an opcode selects a block of positions indexed by the low byte. Most
+    high bytes share their block with others, so only the distinct blocks are generated.
+    """
+    index = decode_index()
+    blocks = [index[high << 8:(high + 1) << 8] for high in range(0x100)]
+    block_numbers = {block: number for number, block in enumerate(dict.fromkeys(blocks))}
+    yield f"static const uint8_t opcode_handlers[{len(block_numbers)}][0x100] = {{"
+    for block in block_numbers:
         yield indented("{")
-        # If we need to skip this instruction, do so...
-        # This allows skipping of 32 bit instructions.
-        yield indented("if (skip)", indent_depth=2)
-        yield indented("{", indent_depth=2)
-        yield indented("SetPC(m, GetPC(m) + {});".format(instructions[0].words), indent_depth=3)
-        yield indented("m->SKIP = false;", indent_depth=3)
-        yield indented("return;", indent_depth=3)
-        yield indented("}", indent_depth=2)
-        if len(instructions) == 1:
-            yield indented("instruction_{}(m, opcode);".format(instructions[0].mnemonic.lower()),
+        for row in range(0, len(block), 32):
+            yield indented(" ".join(f"{position:2}," for position in block[row:row + 32]),
                            indent_depth=2)
-        else:
-            first_instruction = True
-            for name, variable in instructions[0].variables.items():
-                yield indented("const {} {} = {};".format(variable.data_type, name,
-                                                          variable.generate_decoder()),
-                               indent_depth=2)
-            for instruction in instructions:
-                got_else = False
-                if instruction.precondition:
-                    yield indented("{}if ({})".format("" if first_instruction else "else ",
-                                                      instruction.precondition),
-                                   indent_depth=2)
-                else:
-                    got_else = True
-                    if not first_instruction:
-                        yield indented("else", indent_depth=2)
-                    else:
-                        # If we get here there's at least 2 instruction definitions which conflict
-                        # and don't disambiguate themselves with preconditions.
-                        print("Unwanted Collision: Ambiguous instructions...", file=stderr)
-                        print([instruction.mnemonic for instruction in instructions], file=stderr)
-                        yield indented("#warning Unwanted Collision", indent_depth=2)
-                yield indented("{", indent_depth=2)
-                yield indented("instruction_{}(m, opcode);".format(instruction.mnemonic.lower()),
-                               indent_depth=3)
-                yield indented("}", indent_depth=2)
-                first_instruction = False
-                if got_else:
-                    break
-        yield indented("}")
-    yield indented("else")
-    yield indented("{")
+        yield indented("},")
+    yield "};"
+    yield ""
+    yield "static const uint8_t opcode_handler_blocks[0x100] = {"
+    for row in range(0, len(blocks), 32):
+        yield indented(" ".join(f"{block_numbers[block]:2}," for block in blocks[row:row + 32]))
+    yield "};"
+    yield ""
+    yield "static ForceInline uint8_t decode_handler(Mem16 opcode)"
+    yield "{"
+    yield indented("return opcode_handlers[opcode_handler_blocks[opcode >> 8]][opcode & 0xff];")
+    yield "}"
+    yield ""
+    # Words to step over when skipping each position, which also allows
+    # skipping of 32 bit instructions. Opcodes which cannot be decoded are
+    # never skipped.
+    words = [0] + [instructions[0].words for instructions in build_instruction_tree().values()]
+    yield f"static const uint8_t handler_words[{len(words)}] = {{"
+    for row in range(0, len(words), 32):
+        yield indented(" ".join(f"{word}," for word in words[row:row + 32]))
+    yield "};"
+    yield ""
+
+
+def generate_decode_and_execute() -> Iterator[str]:
+    """Generate the instruction decode and execute logic.
+
+    Decoding is a lookup of the opcode in the two level opcode_handlers table.
+    """
+    instruction_tree = build_instruction_tree()
+
+    # Undecodable opcodes should never be executed, so keep their handling
+    # out of the way of the dispatch code.
+    yield "static Cold NoInline void decode_failed(Machine *m, Mem16 opcode) {"
     yield indented(
-        'printf("Warning: Instruction %04x at PC=%04x could not be decoded!\\n", opcode, GetPC(m));',
-        indent_depth=2)
+        'printf("Warning: Instruction %04x at PC=%04x could not be decoded!\\n", opcode, GetPC(m));')
     yield indented("interactive_break(m);")
+    yield "}"
+    yield ""
+    yield "Hot void decode_and_execute_instruction(Machine *m, Mem16 opcode) {"
+    yield indented("const uint8_t handler = decode_handler(opcode);")
+    # If we need to skip this instruction, do so before executing anything
+    yield indented("if (Unlikely(m->SKIP) && handler_words[handler])")
+    yield indented("{")
+    yield indented("SetPC(m, GetPC(m) + handler_words[handler]);", indent_depth=2)
+    yield indented("m->SKIP = false;", indent_depth=2)
+    yield indented("return;", indent_depth=2)
+    yield indented("}")
+    # Generate decode logic
+    yield indented("switch (handler)")
+    yield indented("{")
+    for position, instructions in enumerate(instruction_tree.values(), 1):
+        mnemonics = ", ".join(instruction.mnemonic for instruction in instructions)
+        yield indented(f"case {position}: /* {mnemonics} */")
+        yield indented("{", indent_depth=2)
+        yield from generate_decode_body(instructions, depth=3)
+        yield indented("return;", indent_depth=3)
+        yield indented("}", indent_depth=2)
     yield indented("}")
+    yield indented("decode_failed(m, opcode);")
+    yield "}"
+    yield ""
+
+
+def generate_threaded_dispatch() -> Iterator[str]:
+    """Generate a fetch, decode and execute loop using threaded dispatch.
+
+    Every handler ends with its own fetch and indirect jump to the next
+    handler, rather than all returning to a single dispatch point, which gives
+    the host's branch predictor a separate history for each handler. This needs
+    the labels as values extension so is only available with GCC or clang.
+    """
+    instruction_tree = build_instruction_tree()
+
+    dispatch = (
+        "opcode = GetProgMem(m, GetPC(m));",
+        "handler = decode_handler(opcode);",
+        "goto *handlers[m->SKIP][handler];",
+    )
+    next_instruction = (
+        "PeripheralPostTick(m);",
+        "if (GetPC(m) == last_pc)",
+        "{",
+        indented("return;"),
+        "}",
+        "last_pc = GetPC(m);",
+        "PeripheralPreTick(m);",
+        *dispatch,
+    )
+
+    yield "#if defined(THREADED_DISPATCH) && defined(__GNUC__)"
+    yield "#pragma GCC diagnostic push"
+    yield '#pragma GCC diagnostic ignored "-Wpedantic"'
+    # GCC's cross jumping and global common subexpression elimination merge
+    # the identical fetch and computed goto ending each handler back into one,
+    # which loses the separate branch history for each handler.
+    yield "#ifndef __clang__"
+    yield "#pragma GCC push_options"
+    yield '#pragma GCC optimize("no-crossjumping", "no-gcse")'
+    yield "#endif"
+    yield "Hot void run_until_halt_threaded(Machine *m)"
+    yield "{"
+    # Handlers are selected by whether the instruction is being skipped, so
+    # skipping needs no separate branch. Opcodes which cannot be decoded are
+    # never skipped.
+    yield indented(f"static const void *const handlers[2][{len(instruction_tree) + 1}] = {{")
+    yield indented("{", indent_depth=2)
+    yield indented("&&undecoded,", indent_depth=3)
+    for position in range(1, len(instruction_tree) + 1):
+        yield indented(f"&&decode_{position},", indent_depth=3)
+    yield indented("},", indent_depth=2)
+    yield indented("{", indent_depth=2)
+    yield indented("&&undecoded,", indent_depth=3)
+    for position in range(1, len(instruction_tree) + 1):
+        yield indented("&&skipped,", indent_depth=3)
+    yield indented("},", indent_depth=2)
+    yield indented("};")
+    yield indented("Reg16 last_pc = GetPC(m);")
+    yield indented("Mem16 opcode;")
+    yield indented("uint8_t handler;")
+    yield indented("PeripheralPreTick(m);")
+    for line in dispatch:
+        yield indented(line)
+    yield "skipped:"
+    yield indented("SetPC(m, GetPC(m) + handler_words[handler]);")
+    yield indented("m->SKIP = false;")
+    for line in next_instruction:
+        yield indented(line)
+    yield "undecoded:"
+    yield indented("decode_failed(m, opcode);")
+    for line in next_instruction:
+        yield indented(line)
+    for position, instructions in enumerate(instruction_tree.values(), 1):
+        yield f"decode_{position}:"
+        yield indented("{")
+        yield from generate_decode_body(instructions, depth=2)
+        yield indented("}")
+        for line in next_instruction:
+            yield indented(line)
     yield "}"
+    yield "#ifndef __clang__"
+    yield "#pragma GCC pop_options"
+    yield "#endif"
+    yield "#pragma GCC diagnostic pop"
+    yield "#endif"
     yield ""
 
 
-def generate_instructions():
+def generate_instructions() -> Iterator[str]:
     """Generate instruction implementations."""
     yield "#include \"instructions.h\""
     yield ""
@@ -1004,14 +1323,14 @@ def main():
     else:
         line_terminator = DEFAULT_LINE_TERMINATOR
 
-    # Generate file
-    with open(output_path, "w") as fd:
-        for line in generate_instructions():
-            fd.write(line)
-            fd.write(line_terminator)
-        for line in generate_decode_and_execute():
-            fd.write(line)
-            fd.write(line_terminator)
+    # Generate file as a single string, written in binary so the chosen line
+    # terminator is not translated
+    generators = (generate_instructions, generate_decode_index, generate_decode_and_execute,
+                  generate_threaded_dispatch)
+    lines = [line for generator in generators for line in generator()]
+    lines.append("")
+    with open(output_path, "wb") as fd:
+        fd.write(line_terminator.join(lines).encode("ascii"))
 
 
 if __name__ == "__main__":
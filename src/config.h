@@ -12,4 +12,6 @@
 
 #define USI_CHARACTER_OUTPUT
 
+// #define THREADED_DISPATCH
+
 #endif
@@ -5,6 +5,84 @@
 #include "machine.h"
 #include "machine_accessors.h"
 
+/* Operands spread over several runs of opcode bits can be gathered with a
+   single PEXT on targets with BMI2, otherwise use the shift and mask form. */
+#ifdef __BMI2__
+#include <immintrin.h>
+#define ExtractBits(val, mask, fallback) _pext_u32((val), (mask))
+#else
+#define ExtractBits(val, mask, fallback) (fallback)
+#endif
+
+/* Carry and overflow out of every bit of an 8 bit add/subtract of b to/from a
+   giving r, so carry is bit 7 and half carry bit 3 of the same value. */
+#define AddCarries(a, b, r) (((a) & (b)) | (((a) | (b)) & ~(r)))
+#define SubCarries(a, b, r) ((~(a) & (b)) | ((~(a) | (b)) & (r)))
+#define AddOverflows(a, b, r) (((a) ^ (r)) & ((b) ^ (r)))
+#define SubOverflows(a, b, r) (((a) ^ (b)) & ((a) ^ (r)))
+
+/* Instruction implementations are only called from the decoder, so make
+   sure they are folded into it rather than called. Branch hints let the
+   compiler lay out the expected path of a guest branch as the fall through,
+   and the dispatcher is marked hot while decode failures are kept cold. */
+#ifdef __GNUC__
+#define ForceInline inline __attribute__((always_inline))
+#define NoInline __attribute__((noinline))
+#define Hot __attribute__((hot))
+#define Cold __attribute__((cold))
+#define Likely(x) __builtin_expect(!!(x), 1)
+#define Unlikely(x) __builtin_expect(!!(x), 0)
+#elif defined(_MSC_VER)
+#define ForceInline __forceinline
+#define NoInline __declspec(noinline)
+#define Hot
+#define Cold
+#define Likely(x) (x)
+#define Unlikely(x) (x)
+#else
+#define ForceInline inline
+#define NoInline
+#define Hot
+#define Cold
+#define Likely(x) (x)
+#define Unlikely(x) (x)
+#endif
+
+/* Update H, S, V, N, Z and C after an 8 bit add/subtract of b to/from a giving
+   r. z is the previous zero flag for instructions which can only keep Z set,
+   otherwise true. */
+static ForceInline void UpdateAddFlags(Machine *m, Reg8 a, Reg8 b, Reg8 r, bool z)
+{
+    const Reg8 carries = AddCarries(a, b, r);
+    const bool N = TestBit(r, 7);
+    const bool V = TestBit(AddOverflows(a, b, r), 7);
+    m->SREG[SREG_C] = TestBit(carries, 7);
+    m->SREG[SREG_Z] = (r == 0x00) & z;
+    m->SREG[SREG_N] = N;
+    m->SREG[SREG_V] = V;
+    m->SREG[SREG_S] = N != V;
+    m->SREG[SREG_H] = TestBit(carries, 3);
+}
+
+static ForceInline void UpdateSubFlags(Machine *m, Reg8 a, Reg8 b, Reg8 r, bool z)
+{
+    const Reg8 carries = SubCarries(a, b, r);
+    const bool N = TestBit(r, 7);
+    const bool V = TestBit(SubOverflows(a, b, r), 7);
+    m->SREG[SREG_C] = TestBit(carries, 7);
+    m->SREG[SREG_Z] = (r == 0x00) & z;
+    m->SREG[SREG_N] = N;
+    m->SREG[SREG_V] = V;
+    m->SREG[SREG_S] = N != V;
+    m->SREG[SREG_H] = TestBit(carries, 3);
+}
+
 void decode_and_execute_instruction(Machine *m, Mem16 opcode);
 
+/* Threaded dispatch needs labels as values, so is only used with GCC/clang. */
+#if defined(THREADED_DISPATCH) && defined(__GNUC__)
+#define USE_THREADED_DISPATCH
+void run_until_halt_threaded(Machine *m);
+#endif
+
 #endif
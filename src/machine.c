@@ -17,12 +17,16 @@ void machine_cycle(Machine *m)
 
 void run_until_halt_loop(Machine *m)
 {
+#ifdef USE_THREADED_DISPATCH
+    run_until_halt_threaded(m);
+#else
     Reg16 last_pc = 0xffff;
     while (last_pc != m->PC)
     {
         last_pc = m->PC;
         machine_cycle(m);
     }
+#endif
 }
 
 void dump_registers(Machine *m)
@@ -81,10 +81,10 @@ typedef uint32_t Reg32;
         h = (((v) >> 8) & 0xff); \
         l = (v)&0xff;            \
     } while (0)
-#define SetBit(val, bit) ((val) | (0x1 << (bit)))
-#define GetBit(val, bit) (((val) & (0x1 << (bit))) >> (bit))
-#define TestBit(val, bit) (((val) & (0x1 << (bit))) != 0)
-#define ClearBit(val, bit) ((val) & ~(0x1 << (bit)))
+#define SetBit(val, bit) ((val) | (0x1u << (bit)))
+#define GetBit(val, bit) (((val) >> (bit)) & 0x1u)
+#define TestBit(val, bit) (((val) >> (bit)) & 0x1u)
+#define ClearBit(val, bit) ((val) & ~(0x1u << (bit)))
 
 #define IsNegative(val, bit_count) (((val) & ((1 << ((bit_count)-1)))) != 0)
 #define ToSigned(val, bit_count) (IsNegative(val, bit_count) ? -(((~(val) + 1) & ((1 << (bit_count)) - 1))) : val)
@@ -107,6 +107,7 @@ typedef struct
 {
     bool SREG[8];
     Reg16 PC;
+    bool SKIP;
     Reg8 R[GP_REGISTERS];
     Reg8 IO[IO_REGISTERS];
 #ifdef HAS_EXT_IO_REGISTERS
@@ -115,7 +116,6 @@ typedef struct
     Mem16 FLASH[FLASH_SIZE / 2];
     Mem8 EEPROM[EEPROM_SIZE];
     Mem8 SRAM[SRAM_SIZE];
-    bool SKIP;
 } Machine;
 
 void machine_cycle(Machine *m);
@@ -1,12 +1,15 @@
 """Run individual instruction tests."""
 
+import re
 from argparse import ArgumentParser, Namespace
 from dataclasses import dataclass
-from os import chdir, devnull, getcwd, listdir, mkdir, path, remove
+from hashlib import sha256
+from os import (chdir, cpu_count, getcwd, getpid, link, listdir, makedirs, mkdir, path, remove,
+                replace)
 from shutil import copytree, copy2
-from subprocess import CalledProcessError, check_call
+from subprocess import DEVNULL, PIPE, CalledProcessError, check_call, run
 from tempfile import TemporaryDirectory
-from typing import Iterable, List, Optional
+from typing import Callable, Dict, Iterable, List, Optional
 from multiprocessing import Pool
 
 TEST_ROOT = path.abspath(path.dirname(__file__))
@@ -67,26 +70,91 @@ SECTIONS
 
 """
 
-TEST_MAKEFILE = """\
-CC=avr-gcc
-MCU:={mcu}
-
-TARGET := {test_name}
-
-.PHONY: all
-
-all: $(TARGET).bin
-
-$(TARGET).o: $(TARGET).S
-	$(CC) -mmcu=$(MCU) -o $(TARGET).o -c $(TARGET).S
-
-$(TARGET).out: $(TARGET).o
-	avr-ld -Tlinker.ld $(TARGET).o -o $(TARGET).out
-
-$(TARGET).bin: $(TARGET).out
-	avr-objcopy -O binary $(TARGET).out $(TARGET).bin
+# Commands to assemble, link and extract the binary of a test, run in order. The
+# assembly is generated in memory so is read from stdin rather than a file
+TEST_BUILD = (
+    ("avr-gcc", "-mmcu={mcu}", "-x", "assembler-with-cpp", "-o", "{test}.o", "-c", "-"),
+    ("avr-ld", "-T{linker}", "{test}.o", "-o", "{test}.out"),
+    ("avr-objcopy", "-O", "binary", "{test}.out", "{test}.bin"),
+)
+
+# Single word instructions whose operands are all registers or immediates, which can be
+# assembled without the AVR toolchain with --inline-asm. These are written out from the AVR
+# instruction set manual rather than taken from instructions.py, so a mistake in the
+# simulator's decoding still fails the tests. Five bit register fields reach all registers
+# and four bit ones r16 to r31.
+INLINE_OPCODES = {
+    "adc": ("0001_11rd_dddd_rrrr", "dr"),
+    "add": ("0000_11rd_dddd_rrrr", "dr"),
+    "and": ("0010_00rd_dddd_rrrr", "dr"),
+    "andi": ("0111_KKKK_dddd_KKKK", "dK"),
+    "asr": ("1001_010d_dddd_0101", "d"),
+    "bld": ("1111_100d_dddd_0bbb", "db"),
+    "bst": ("1111_101d_dddd_0bbb", "db"),
+    "com": ("1001_010d_dddd_0000", "d"),
+    "cp": ("0001_01rd_dddd_rrrr", "dr"),
+    "cpc": ("0000_01rd_dddd_rrrr", "dr"),
+    "cpi": ("0011_KKKK_dddd_KKKK", "dK"),
+    "dec": ("1001_010d_dddd_1010", "d"),
+    "eor": ("0010_01rd_dddd_rrrr", "dr"),
+    "inc": ("1001_010d_dddd_0011", "d"),
+    "ldi": ("1110_KKKK_dddd_KKKK", "dK"),
+    "lsr": ("1001_010d_dddd_0110", "d"),
+    "mov": ("0010_11rd_dddd_rrrr", "dr"),
+    "neg": ("1001_010d_dddd_0001", "d"),
+    "nop": ("0000_0000_0000_0000", ""),
+    "or": ("0010_10rd_dddd_rrrr", "dr"),
+    "ori": ("0110_KKKK_dddd_KKKK", "dK"),
+    "ror": ("1001_010d_dddd_0111", "d"),
+    "sbc": ("0000_10rd_dddd_rrrr", "dr"),
+    "sbci": ("0100_KKKK_dddd_KKKK", "dK"),
+    "sub": ("0001_10rd_dddd_rrrr", "dr"),
+    "subi": ("0101_KKKK_dddd_KKKK", "dK"),
+    "swap": ("1001_010d_dddd_0010", "d"),
+}
 
-"""
+# Aliases which are another instruction with their one register operand repeated
+INLINE_ALIASES = {"clr": "eor", "lsl": "add", "rol": "adc", "tst": "and"}
+
+# Every test ends in "rjmp halt_loop", a relative jump back to itself
+HALT_LOOP_OPCODE = 0xcfff
+
+
+def assemble_line(line: str) -> Optional[int]:
+    """Assemble a line of a test to its opcode, or None if it needs the AVR toolchain."""
+    mnemonic, *operand_text = line.lower().split(None, 1)
+    operands = [x.strip() for x in operand_text[0].split(",")] if operand_text else []
+    if mnemonic in INLINE_ALIASES:
+        mnemonic = INLINE_ALIASES[mnemonic]
+        operands *= 2
+    if mnemonic not in INLINE_OPCODES:
+        return None
+
+    opcode_bits, fields = INLINE_OPCODES[mnemonic]
+    opcode_bits = opcode_bits.replace("_", "")
+    if len(operands) != len(fields):
+        return None
+
+    opcode = int(re.sub("[^1]", "0", opcode_bits), 2)
+    for field, operand in zip(fields, operands):
+        # Bit positions of the field, most significant first
+        positions = [15 - index for index, bit in enumerate(opcode_bits) if bit == field]
+        if field in ("d", "r"):
+            register = re.fullmatch(r"r(\d+)", operand)
+            if not register:
+                return None
+            value = int(register[1]) - (16 if len(positions) == 4 else 0)
+        else:
+            try:
+                value = int(operand, 0)
+            except ValueError:
+                return None
+        if not 0 <= value < 1 << len(positions):
+            return None
+        for index, position in enumerate(positions):
+            if value & (1 << (len(positions) - 1 - index)):
+                opcode |= 1 << position
+    return opcode
 
 
 @dataclass
@@ -106,125 +174,193 @@ class Test:
         """Read test from file."""
         name, *_ = path.splitext(path.basename(file_path))
 
-        precondition: List[str] = []
-        postcondition: List[str] = []
-        test: List[str] = []
-        parameter_variables: List[str] = []
-        parameter_values: List[List[str]] = []
-
-        in_precondition = False
-        in_postcondition = False
-        in_test = False
-        in_parameters = False
-
-        with open(file_path, "r") as lines:
-            for line in lines:
-                line = line.strip()
-                if line.startswith("---"):
-                    in_precondition = False
-                    in_postcondition = False
-                    in_test = False
-
-                    split_line = line.split()
-                    if len(split_line) < 2:
-                        section = ""
-                    else:
-                        _, section, *_ = split_line
-                    section = section.strip()
-
-                    if section == "precondition":
-                        in_precondition = True
-                    elif section == "postcondition":
-                        in_postcondition = True
-                    elif section == "test":
-                        in_test = True
-                    elif section == "parameters":
-                        in_parameters = True
-                elif in_precondition:
-                    precondition.append(line)
-                elif in_postcondition:
-                    postcondition.append(line)
-                elif in_test:
-                    test.append(line)
-                elif in_parameters:
-                    if not parameter_variables:
-                        parameter_variables = [x.strip() for x in line.split(",")]
-                    else:
-                        parameter_values.append([x.strip() for x in line.split(",")])
+        with open(file_path, "r") as test_file:
+            lines = [line.strip() for line in test_file.read().splitlines()]
+
+        # Each section runs from its "---" header to the next header
+        headers = [index for index, line in enumerate(lines) if line.startswith("---")]
+        sections: Dict[str, List[str]] = {}
+        for start, end in zip(headers, headers[1:] + [len(lines)]):
+            _, *section = lines[start].split()
+            sections.setdefault(section[0] if section else "", []).extend(lines[start + 1:end])
+
+        precondition = sections.get("precondition", [])
+        postcondition = sections.get("postcondition", [])
+        test = sections.get("test", [])
+        parameter_variables, *parameter_values = [[x.strip() for x in line.split(",")]
+                                                  for line in sections.get("parameters", [])
+                                                  ] or [[]]
 
         return Test(name, name, precondition, test, postcondition,
                     parameter_variables if parameter_variables else None,
                     parameter_values if parameter_values else None)
 
-
-def get_tests() -> Iterable[Test]:
-    """Get all tests."""
+    def assemble_inline(self) -> Optional[bytes]:
+        """Assemble the test's binary, or None if it needs the AVR toolchain."""
+        opcodes = list()
+        for line in self.test:
+            if line:
+                opcode = assemble_line(line)
+                if opcode is None:
+                    return None
+                opcodes.append(opcode)
+        opcodes.append(HALT_LOOP_OPCODE)
+        return b"".join(opcode.to_bytes(2, "little") for opcode in opcodes)
+
+
+def get_tests(predicate: Callable[[str], bool] = lambda name: True) -> Iterable[Test]:
+    """Get all tests, or only those whose name matches the predicate."""
     test_search_dir = path.join(TEST_ROOT, "instruction_tests")
 
     for item_name in listdir(test_search_dir):
         full_path = path.join(test_search_dir, item_name)
+        test_name, extension = path.splitext(item_name)
 
-        if path.isfile(full_path) and path.splitext(full_path)[-1] == ".test":
+        if extension == ".test" and predicate(test_name) and path.isfile(full_path):
             yield Test.from_file(full_path)
 
 
+def link_file(source: str, destination: str) -> str:
+    """Hard link a file, or copy it where the filesystem can't link it."""
+    try:
+        link(source, destination)
+    except OSError:
+        copy2(source, destination)
+    return destination
+
+
+def link_tree(source: str, destination: str) -> str:
+    """Hard link a directory tree, files which are only read by a test can be shared."""
+    return copytree(source, destination, copy_function=link_file)
+
+
+def cached_binary_path(test_asm: str, parsed_arguments: Namespace) -> Optional[str]:
+    """Get where the binary for a test's assembly is cached, or None if not caching."""
+    if not parsed_arguments.cache_dir:
+        return None
+    key = sha256("\n".join((parsed_arguments.mcu, TEST_LINKER, test_asm)).encode()).hexdigest()
+    return path.join(parsed_arguments.cache_dir, "{}.bin".format(key))
+
+
+def store_cached_binary(binary_path: str, cached_path: str):
+    """Add a built binary to the cache, keeping any entry another test already added."""
+    makedirs(path.dirname(cached_path), exist_ok=True)
+    try:
+        link(binary_path, cached_path)
+    except FileExistsError:
+        pass
+    except OSError:
+        # Copy under a temporary name first so a partly written binary is never
+        # found in the cache
+        temporary_path = "{}.{}".format(cached_path, getpid())
+        copy2(binary_path, temporary_path)
+        replace(temporary_path, cached_path)
+
+
+def make_variables(parsed_arguments: Namespace) -> List[str]:
+    """Get the variables to pass to make for the prebuild and each test's build."""
+    variables = [
+        "PYTHON={}".format(parsed_arguments.python or "python3"),
+        "CCACHE={}".format(parsed_arguments.ccache or "")
+    ]
+    # Every test links against the prebuilt objects, so both builds need the same flags
+    if parsed_arguments.cflags:
+        variables.append("CFLAGS={}".format(parsed_arguments.cflags))
+    return variables
+
+
 def run_test(test: Test, parsed_arguments: Namespace, pooled_prefix="") -> int:
     """Run a test."""
     test_dir = test.name
 
-    mkdir(test_dir)
+    # Generate the sources before creating anything, so a bad test leaves no
+    # partial directory behind
+    test_c = MAIN_OUTLINE.format(test_name=test.name,
+                                 test_path=test_dir,
+                                 pre="\n    ".join(test.precondition),
+                                 post="\n    ".join(test.postcondition))
+    test_asm = TEST_OUTLINE.format(test="\n    ".join(test.test))
 
-    copytree("../src", path.join(test_dir, "src"))
-    copytree("../obj", path.join(test_dir, "obj"))
-    copy2("../Makefile", path.join(test_dir, "Makefile"))
-    copy2("../instructions.py", path.join(test_dir, "instructions.py"))
+    makedirs(path.join(test_dir, "test"))
 
-    with open(path.join(test_dir, "src", "atsim.c"), "w") as test_c_file:
-        test_c_file.write(
-            MAIN_OUTLINE.format(test_name=test.name,
-                                test_path=test_dir,
-                                pre="\n    ".join(test.precondition),
-                                post="\n    ".join(test.postcondition)))
+    # The prebuilt tree is only read by each test, anything a test builds is
+    # written to a new file so never changes the shared copy
+    link_tree("../src", path.join(test_dir, "src"))
+    link_tree("../obj", path.join(test_dir, "obj"))
+    link_file("../Makefile", path.join(test_dir, "Makefile"))
 
-    mkdir(path.join(test_dir, "test"))
-
-    with open(path.join(test_dir, "test", "{}.S".format(test.name)), "w") as test_asm_file:
-        test_asm_file.write(TEST_OUTLINE.format(test="\n    ".join(test.test)))
+    with open(path.join(test_dir, "src", "atsim.c"), "w") as test_c_file:
+        test_c_file.write(test_c)
 
-    with open(path.join(test_dir, "test", "linker.ld"), "w") as test_asm_linker_file:
-        test_asm_linker_file.write(TEST_LINKER)
+    test_path = path.join(test_dir, "test", test.name)
+    linker_path = path.join(test_dir, "test", "linker.ld")
+    cached_path = cached_binary_path(test_asm, parsed_arguments)
+    test_binary = test.assemble_inline() if parsed_arguments.inline_asm else None
 
-    with open(path.join(test_dir, "test", "Makefile"), "w") as test_asm_makefile_file:
-        test_asm_makefile_file.write(
-            TEST_MAKEFILE.format(test_name=test.name, mcu=parsed_arguments.mcu))
+    if test_binary is not None:
+        # Simple tests don't need three toolchain processes to produce a few opcodes
+        if parsed_arguments.pool < 2:
+            print("  Assembling AVR test inline...")
+        with open("{}.bin".format(test_path), "wb") as test_binary_file:
+            test_binary_file.write(test_binary)
+    elif cached_path and path.isfile(cached_path):
+        if parsed_arguments.pool < 2:
+            print("  Using cached AVR test...")
+        link_file(cached_path, "{}.bin".format(test_path))
+    else:
+        if parsed_arguments.pool < 2:
+            print("  Building AVR test...")
 
-    if parsed_arguments.pool < 2:
-        print("  Building AVR test...")
+        # avr-ld can only read its script from a file
+        with open(linker_path, "w") as test_asm_linker_file:
+            test_asm_linker_file.write(TEST_LINKER)
 
-    with open(devnull, "w") as null_out:
+        # With only three steps and nothing to skip, call the toolchain directly
+        # rather than through make
         try:
-            check_call(["make", "-C", path.join(test_dir, "test")], stdout=null_out)
-        except CalledProcessError as error:
+            for command in TEST_BUILD:
+                run([
+                    part.format(mcu=parsed_arguments.mcu, test=test_path, linker=linker_path)
+                    for part in command
+                ],
+                    input=test_asm if "-" in command else None,
+                    stdout=DEVNULL,
+                    stderr=PIPE,
+                    universal_newlines=True,
+                    check=True)
+        except (CalledProcessError, OSError) as error:
+            # A missing toolchain fails to start rather than returning an error
             if parsed_arguments.pool < 2:
                 print("  BUILD FAILURE")
             else:
                 print("  {}BUILD '{}' FAILURE".format(pooled_prefix, test.display_name))
-            return error.returncode
+            # The toolchain's output is only worth showing when it fails
+            print(error.stderr if isinstance(error, CalledProcessError) else "  {}\n".format(error),
+                  end="")
+            return getattr(error, "returncode", 1)
 
+        if cached_path:
+            store_cached_binary("{}.bin".format(test_path), cached_path)
+
+    if parsed_arguments.pool < 2:
+        print("  Building simulator harness...")
+    # The instructions were generated by the prebuild, so tell make not to
+    # look for the generator which isn't linked into the test
+    try:
+        run([
+            "make", "-C", test_dir, "-o", "instructions.py", *make_variables(parsed_arguments)
+        ],
+            stdout=DEVNULL,
+            stderr=PIPE,
+            universal_newlines=True,
+            check=True)
+    except CalledProcessError as error:
         if parsed_arguments.pool < 2:
-            print("  Building simulator harness...")
-        try:
-            check_call([
-                "make", "-C", test_dir, "PYTHON={}".format(parsed_arguments.python)
-                if parsed_arguments.python else "python3"
-            ],
-                       stdout=null_out)
-        except CalledProcessError as error:
-            if parsed_arguments.pool < 2:
-                print("  BUILD FAILURE")
-            else:
-                print("  {}BUILD '{}' FAILURE".format(pooled_prefix, test.display_name))
-            return error.returncode
+            print("  BUILD FAILURE")
+        else:
+            print("  {}BUILD '{}' FAILURE".format(pooled_prefix, test.display_name))
+        print(error.stderr, end="")
+        return error.returncode
 
     if parsed_arguments.pool < 2:
         print("  Executing test...")
@@ -253,17 +389,23 @@ def expand_parametrised_tests(tests: Iterable[Test]) -> Iterable[Test]:
     """Expand parametrised tests into a number of tests."""
     for test in tests:
         if test.parameter_variables and test.parameter_values:
+            # Substitute every variable in one pass over each line, trying longer
+            # names first so a variable can't match the start of another
+            variable_pattern = re.compile("|".join(
+                re.escape(var) for var in sorted(test.parameter_variables, key=len, reverse=True)))
             for counter, value_set in enumerate(test.parameter_values):
                 if len(value_set) != len(test.parameter_variables):
                     continue
-                new_test_precondition = list(test.precondition)
-                new_test_body = list(test.test)
-                new_test_postcondition = list(test.postcondition)
+                values = dict(zip(test.parameter_variables, value_set))
+
+                def substitute(lines: List[str]) -> List[str]:
+                    return [variable_pattern.sub(lambda match: values[match[0]], x) for x in lines]
+
+                new_test_precondition = substitute(test.precondition)
+                new_test_body = substitute(test.test)
+                new_test_postcondition = substitute(test.postcondition)
                 new_test_display_name = test.name
                 for var, val in zip(test.parameter_variables, value_set):
-                    new_test_precondition = [x.replace(var, val) for x in new_test_precondition]
-                    new_test_body = [x.replace(var, val) for x in new_test_body]
-                    new_test_postcondition = [x.replace(var, val) for x in new_test_postcondition]
                     new_test_display_name += " {}={}".format(var, val)
                 new_test_name = "{}_p{}".format(test.name, counter)
                 yield Test(new_test_name, new_test_display_name, new_test_precondition,
@@ -276,17 +418,29 @@ def expand_parametrised_tests(tests: Iterable[Test]) -> Iterable[Test]:
 
 def run_tests(test_dir: str, parsed_arguments: Namespace) -> int:
     """Run all tests until a failure, or the end."""
-    all_tests = list(expand_parametrised_tests(get_tests()))
-
     # Filter out tests that aren't selected
     if parsed_arguments.tests != "all":
         specified_tests = set(parsed_arguments.tests.split(","))
         wild_specified_tests = set(filter(lambda x: x.endswith("*"), specified_tests))
         specified_tests.difference_update(wild_specified_tests)
-        for test in list(all_tests):
-            if test.name not in specified_tests and not any(
-                    test.name.startswith(wildcard[:-1]) for wildcard in wild_specified_tests):
-                all_tests.remove(test)
+
+        def is_selected(name: str) -> bool:
+            return name in specified_tests or any(
+                name.startswith(wildcard[:-1]) for wildcard in wild_specified_tests)
+
+        def may_be_selected(name: str) -> bool:
+            # Only read the test files which are selected, or which could expand
+            # into selected tests named with a _p<n> suffix
+            return is_selected(name) or any(
+                test_name.startswith(name + "_p") for test_name in specified_tests) or any(
+                    wildcard[:-1].startswith(name) for wildcard in wild_specified_tests)
+
+        all_tests = [
+            test for test in expand_parametrised_tests(get_tests(may_be_selected))
+            if is_selected(test.name)
+        ]
+    else:
+        all_tests = list(expand_parametrised_tests(get_tests()))
 
     test_count = len(all_tests)
     chdir(path.join(test_dir, "tests"))
@@ -295,13 +449,14 @@ def run_tests(test_dir: str, parsed_arguments: Namespace) -> int:
     if parsed_arguments.pool > 1:
         # run in parallel
         print("Running tests with pool of {}...".format(parsed_arguments.pool))
+        pooled_tests = [(test, parsed_arguments, "{:03d}/{:03d} ".format(test_index, test_count))
+                        for test_index, test in enumerate(all_tests, 1)]
         with Pool(parsed_arguments.pool) as p:
-            pool_result = p.map(
-                run_test_wrapper,
-                [(test, parsed_arguments, "{:03d}/{:03d} ".format(test_index, test_count))
-                 for test_index, test in enumerate(all_tests, 1)])
-            if any(pool_result):
-                return 1
+            # Take results as tests finish, leaving the pool on the first failure
+            # terminates any tests still running
+            for result in p.imap_unordered(run_test_wrapper, pooled_tests):
+                if result != 0:
+                    return result
     else:
         # run in serial
         for test_index, test in enumerate(all_tests, 1):
@@ -319,18 +474,20 @@ def prebuild(test_dir: str, parsed_arguments: Namespace) -> int:
     original_location = getcwd()
     chdir(test_dir)
     print("Prebuilding shared data...")
-    with open(devnull, "w") as null_out:
-        try:
-            check_call([
-                "make", "PYTHON={}".format(parsed_arguments.python)
-                if parsed_arguments.python else "python3"
-            ],
-                       stdout=null_out)
-        except CalledProcessError as error:
-            print("  BUILD FAILURE")
-            return error.returncode
-        finally:
-            chdir(original_location)
+    try:
+        run([
+            "make", *make_variables(parsed_arguments)
+        ],
+            stdout=DEVNULL,
+            stderr=PIPE,
+            universal_newlines=True,
+            check=True)
+    except CalledProcessError as error:
+        print("  BUILD FAILURE")
+        print(error.stderr, end="")
+        return error.returncode
+    finally:
+        chdir(original_location)
     print("  BUILD SUCCESS")
     return 0
 
@@ -339,19 +496,53 @@ def main() -> int:
     """Entry point."""
     argument_parser = ArgumentParser()
 
-    argument_parser.add_argument("--pool", type=int, default=1)
+    argument_parser.add_argument("--pool",
+                                 type=int,
+                                 default=1,
+                                 help="Tests to run at once, at most twice the CPU count.")
     argument_parser.add_argument("--mcu", default="attiny85")
     argument_parser.add_argument("--python", default="python3")
+    argument_parser.add_argument(
+        "--ccache",
+        default=None,
+        help="Compiler cache to build the simulator through, e.g. ccache.")
     argument_parser.add_argument("--tests", default="all")
+    argument_parser.add_argument(
+        "--cflags",
+        default=None,
+        help="Flags to build the simulator with instead of the Makefile's, e.g. to add "
+        "-DTHREADED_DISPATCH.")
+    argument_parser.add_argument(
+        "--inline-asm",
+        action="store_true",
+        help="Assemble tests simple enough to not need the AVR toolchain, which is otherwise "
+        "used for every test.")
+    argument_parser.add_argument(
+        "--tmp-root",
+        default=None,
+        help="Directory to build and run tests in, e.g. a tmpfs such as /dev/shm if it allows "
+        "executables.")
+    argument_parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory to keep built AVR test binaries in, reused while a test is unchanged.")
 
     parsed_arguments = argument_parser.parse_args()
 
+    # Tests are run from within the temporary directory
+    if parsed_arguments.cache_dir:
+        parsed_arguments.cache_dir = path.abspath(parsed_arguments.cache_dir)
+
+    # Each test is a chain of compiler processes, so more workers than this only
+    # contend for the same cores
+    parsed_arguments.pool = max(1, min(parsed_arguments.pool, 2 * (cpu_count() or 1)))
+
     print("Running tests...")
 
     result_code = 0
 
     # Run tests in a temporary directory
-    with TemporaryDirectory(prefix="avr_tests") as test_dir:
+    with TemporaryDirectory(prefix="avr_tests", dir=parsed_arguments.tmp_root) as test_dir:
         # Copy source code to temp directory
         copytree(path.join(TEST_ROOT, "../src"), path.join(test_dir, "src"))
 
@@ -359,26 +550,29 @@ def main() -> int:
         copy2(path.join(TEST_ROOT, "../Makefile"), path.join(test_dir, "Makefile"))
         copy2(path.join(TEST_ROOT, "../instructions.py"), path.join(test_dir, "instructions.py"))
 
-        # Prebuild the VM
-        prebuild(test_dir, parsed_arguments)
+        # Prebuild the VM, there's nothing to test if that fails
+        result_code = prebuild(test_dir, parsed_arguments)
+        if result_code == 0:
+            # Remove main C file to be replaced per test, along with its build
+            # output so each test writes its own rather than through a shared link
+            remove(path.join(test_dir, "src", "atsim.c"))
+            remove(path.join(test_dir, "obj", "atsim.o"))
+            remove(path.join(test_dir, "obj", "atsim.d"))
 
-        # Remove main C file to be replaced per test
-        remove(path.join(test_dir, "src", "atsim.c"))
+            # Create directory for individual tests
+            mkdir(path.join(test_dir, "tests"))
 
-        # Create directory for individual tests
-        mkdir(path.join(test_dir, "tests"))
+            # Track where we are
+            original_location = getcwd()
 
-        # Track where we are
-        original_location = getcwd()
+            # Move to the test directory
+            chdir(test_dir)
 
-        # Move to the test directory
-        chdir(test_dir)
+            # Run all the selected tests
+            result_code = run_tests(test_dir, parsed_arguments)
 
-        # Run all the selected tests
-        result_code = run_tests(test_dir, parsed_arguments)
-
-        # Restore original location
-        chdir(original_location)
+            # Restore original location
+            chdir(original_location)
 
     if result_code == 0:
         print("Tests successful!")